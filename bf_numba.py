@@ -0,0 +1,82 @@
+"""
+Bellman-Ford relaxation over a graph in compressed sparse row (CSR) form, compiled to native code
+with Numba when it is installed. Without Numba the very same function runs as plain Python, which
+is no faster than BellmanFord.shortest_paths, so callers check NUMBA_AVAILABLE first.
+"""
+import math
+from array import array
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:  # Numba is optional
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+
+@njit(cache=True, boundscheck=False)
+def _relax(vertex_starts, edge_targets, edge_weights, start_vertex, tolerance, distance, predecessor):
+    """
+    Repeatedly relax every edge, filling in distance and predecessor in place.
+
+    :return: (u, v) of an edge in a negative cycle, or (-1, -1) if there is none
+    """
+    num_vertices = len(vertex_starts) - 1
+
+    # repeated relaxation
+    for i in range(num_vertices):
+        for u in range(num_vertices):
+            distance_u = distance[u]
+            if distance_u == math.inf:
+                continue
+            for k in range(vertex_starts[u], vertex_starts[u + 1]):
+                v = edge_targets[k]
+                w = edge_weights[k]
+                if distance[v] - (distance_u + w) > tolerance:
+                    if v == start_vertex:
+                        return u, v
+                    distance[v] = distance_u + w
+                    predecessor[v] = u
+
+    # check for negative cycles
+    for u in range(num_vertices):
+        for k in range(vertex_starts[u], vertex_starts[u + 1]):
+            v = edge_targets[k]
+            if distance[v] - (distance[u] + edge_weights[k]) > tolerance:
+                return u, v
+
+    return -1, -1
+
+
+def bf_csr(vertex_starts, edge_targets, edge_weights, start_vertex, tolerance=0):
+    """
+    Find the shortest paths from start_vertex over a CSR graph and detect a negative cycle.
+    Vertices are the integers 0..n-1 and the edges leaving vertex u are edge_targets[k] with weight
+    edge_weights[k] for k in range(vertex_starts[u], vertex_starts[u + 1]).
+
+    >>> V = array('i', [0, 2, 4, 6, 6, 7])  # a=0, b=1, c=2, d=3, e=4
+    >>> E = array('i', [1, 2, 2, 0, 0, 3, 0])
+    >>> W = array('d', [1, 5, 2, 10, 14, -3, 100])
+    >>> dist, pred, neg_u, neg_v = bf_csr(V, E, W, 0)
+    >>> list(dist), list(pred), neg_u, neg_v
+    ([0.0, 1.0, 3.0, 0.0, inf], [-1, 0, 1, 2, -1], -1, -1)
+
+    :param vertex_starts: n + 1 offsets into edge_targets/edge_weights, one run per source vertex
+    :param edge_targets: target vertex of each edge, grouped by source vertex
+    :param edge_weights: weight of each edge, parallel to edge_targets
+    :param start_vertex: start of all paths
+    :param tolerance: only if a path is more than tolerance better will it be relaxed
+    :return: (distance, predecessor, neg_edge_u, neg_edge_v)
+        distance:    array('d') of shortest distances from start_vertex
+        predecessor: array('i') of previous vertex in each shortest path (-1 if none)
+        neg_edge_u, neg_edge_v: an edge in a negative cycle, or -1, -1 if there is none
+    """
+    num_vertices = len(vertex_starts) - 1
+    distance = array('d', [math.inf]) * num_vertices
+    predecessor = array('i', [-1]) * num_vertices
+    distance[start_vertex] = 0
+    neg_edge_u, neg_edge_v = _relax(vertex_starts, edge_targets, edge_weights, start_vertex, tolerance,
+                                    distance, predecessor)
+    return distance, predecessor, neg_edge_u, neg_edge_v
@@ -1,25 +1,41 @@
-import ipaddress
-from array import array
+import math
+import struct
+import sys
+from collections import namedtuple
 from datetime import datetime, timedelta
 
 MAX_QUOTES_PER_MESSAGE = 50
 MICROS_PER_SECOND = 1_000_000
 
+# Parsed quotes of one message as parallel sequences, one entry per quote; timestamps are microseconds
+# since epoch and neg_logs are the Bellman-Ford edge weights -log(price).
+Quotes = namedtuple('Quotes', 'crosses prices timestamps neg_logs')
+
+# Compiled once so the format strings are not looked up again on every call.
+_PRICE = struct.Struct('<f')
+# IPv4 address (4 bytes) followed by the port (2 bytes), both in network byte order.
+_ADDRESS = struct.Struct('!4BH')
+# One 32-byte quote record: both 3-letter currencies together, the little-endian price, the raw big-endian
+# timestamp (kept as bytes because it has the opposite byte order to the price) and 14 bytes of padding.
+_QUOTE = struct.Struct('<6sf8s14x')
+
+# Cross string for each 6-byte currency field seen so far, e.g. b'GBPUSD' -> 'GBP/USD'.
+_crosses = {}
+# Interned currency codes for each cross seen so far, e.g. 'GBP/USD' -> ('GBP', 'USD').
+_currency_pairs = {}
+
 
 def deserialize_price(b: bytes) -> float:
 	"""
 	Convert a byte array from the price feed into a float.
 
-	>>> deserialize_price(b'\xd5\xe9\xf6B')
-	123.45669555664062
+	>>> deserialize_price(b'\\xd5\\xe9\\xf6B')
+	123.45670318603516
 
 	:param b: byte array representing price (4 bytes, IEEE 754 binary32 little-endian)
 	:return: float representation of the byte array
 	"""
-	a = array('f')  # 4-byte float, not 8-byte double
-	a.frombytes(b)
-	# No byteswap needed - already in little-endian format
-	return a[0]
+	return _PRICE.unpack(b)[0]
 
 
 def serialize_address(address: (str, int)) -> bytes:
@@ -28,13 +44,37 @@ def serialize_address(address: (str, int)) -> bytes:
 	
 	>>> serialize_address(('127.0.0.1', 65534))
 	b'\\x7f\\x00\\x00\\x01\\xff\\xfe'
+	>>> serialize_address(('1.2.3.4.5', 80))
+	Traceback (most recent call last):
+	...
+	ValueError: '1.2.3.4.5' is not a dotted-quad IPv4 address
 	
-	:param address: tuple of (ip_string, port)
+	:param address: tuple of (ipv4_string, port)
 	:return: 6-byte sequence (4 bytes IP + 2 bytes port in big-endian)
+	:raises ValueError: if the IP is not a dotted-quad IPv4 address or the port does not fit in 2 bytes
 	"""
-	ip_bytes = ipaddress.ip_address(address[0]).packed
-	port_bytes = address[1].to_bytes(2, byteorder='big')
-	return ip_bytes + port_bytes
+	ip, port = address
+	octets = ip.split('.')
+	if len(octets) != 4:
+		raise ValueError(f"{ip!r} is not a dotted-quad IPv4 address")
+	try:
+		return _ADDRESS.pack(int(octets[0]), int(octets[1]), int(octets[2]), int(octets[3]), port)
+	except (ValueError, struct.error):
+		raise ValueError(f"{address!r} is not a valid IPv4 address and port") from None
+
+
+def deserialize_utcmicros(b: bytes) -> int:
+	"""
+	Convert an 8-byte timestamp into an integer number of microseconds since Unix epoch.
+	Timestamp is in big-endian format.
+	
+	>>> deserialize_utcmicros(b'\\x00\\x007\\xa3e\\x8e\\xf2\\xc0')
+	61174923064000
+	
+	:param b: 8-byte sequence in big-endian
+	:return: microseconds since 00:00:00 UTC on 1 January 1970
+	"""
+	return int.from_bytes(b, 'big')
 
 
 def deserialize_utcdatetime(b: bytes) -> datetime:
@@ -48,15 +88,38 @@ def deserialize_utcdatetime(b: bytes) -> datetime:
 	:param b: 8-byte sequence in big-endian
 	:return: datetime object
 	"""
-	a = array('Q')  # 8-byte unsigned long long
-	a.frombytes(b)
-	a.byteswap()  # convert from big-endian to little-endian
-	micros = a[0]
 	epoch = datetime(1970, 1, 1)
-	return epoch + timedelta(microseconds=micros)
+	return epoch + timedelta(microseconds=deserialize_utcmicros(b))
+
 
+def _new_cross(currencies: bytes) -> str:
+	"""Decode a 6-byte currency field not seen before into its interned cross, e.g. 'GBP/USD'."""
+	cross = sys.intern(currencies[:3].decode('ascii') + '/' + currencies[3:].decode('ascii'))
+	return _crosses.setdefault(currencies, cross)
 
-def unmarshal_message(b: bytes):
+
+def split_cross(cross: str) -> (str, str):
+	"""
+	Split a cross into its two currencies. There are only a handful of currencies, so the codes are
+	interned and cached per cross: the same str objects come back every time, which keeps the dict
+	lookups keyed on them cheap.
+
+	>>> split_cross('GBP/USD')
+	('GBP', 'USD')
+	>>> split_cross('GBP/USD')[0] is split_cross(''.join(['GBP', '/', 'USD']))[0]
+	True
+
+	:param cross: currency pair such as 'GBP/USD'
+	:return: tuple of (base_currency, quote_currency)
+	"""
+	pair = _currency_pairs.get(cross)
+	if pair is None:
+		base_currency, quote_currency = cross.split('/')
+		pair = _currency_pairs[cross] = (sys.intern(base_currency), sys.intern(quote_currency))
+	return pair
+
+
+def unmarshal_message(b):
 	"""
 	Parse a forex provider message containing one or more quotes.
 	Each quote is 32 bytes:
@@ -66,28 +129,39 @@ def unmarshal_message(b: bytes):
 	- Bytes 10-17: Timestamp (8 bytes, big-endian microseconds since epoch)
 	- Bytes 18-31: Reserved/padding (14 bytes)
 	
-	:param b: bytes object containing the message (32 bytes per quote)
-	:return: list of dicts: [{'cross': 'GBP/USD', 'price': 1.22041, 'timestamp': datetime}, ...]
-	"""
-	num_quotes = len(b) // 32
-	quotes = []  # Use list, not dict
+	>>> import fxp_bytes
+	>>> q1 = {'cross': 'GBP/USD', 'price': 1.22041, 'time': datetime(2006, 1, 2)}
+	>>> q2 = {'cross': 'USD/JPY', 'price': 108.2755, 'time': datetime(2006, 1, 1)}
+	>>> message = fxp_bytes.marshal_message([q1, q2]) + b'\\x00' * 5  # trailing partial record is ignored
+	>>> quotes = unmarshal_message(memoryview(message))
+	>>> quotes.crosses
+	['GBP/USD', 'USD/JPY']
+	>>> [round(price, 4) for price in quotes.prices]  # binary32 on the wire
+	[1.2204, 108.2755]
+	>>> quotes.timestamps  # integer microseconds since epoch
+	[1136160000000000, 1136073600000000]
+	>>> [round(neg_log, 6) for neg_log in quotes.neg_logs]
+	[-0.199187, -4.684679]
+	>>> unmarshal_message(b'')
+	Quotes(crosses=[], prices=[], timestamps=[], neg_logs=[])
 	
-	for x in range(num_quotes):
-		quote_bytes = b[x*32:(x+1)*32]
-		quote = {}
-		
-		# Bytes 0-2: First currency
-		curr1 = quote_bytes[0:3].decode("ascii")
-		# Bytes 3-5: Second currency
-		curr2 = quote_bytes[3:6].decode("ascii")
-		quote["cross"] = f"{curr1}/{curr2}"
-		
-		# Bytes 6-9: Price (4 bytes, little-endian float)
-		quote["price"] = deserialize_price(quote_bytes[6:10])
-		
-		# Bytes 10-17: Timestamp (8 bytes, big-endian)
-		quote["timestamp"] = deserialize_utcdatetime(quote_bytes[10:18])
-		
-		quotes.append(quote)
-		
-	return quotes
+	:param b: bytes-like object (bytes, bytearray or memoryview) containing the message (32 bytes per quote)
+	:return: Quotes(crosses=['GBP/USD', ...], prices=[1.22041, ...], timestamps=[1136160000000000, ...], neg_logs=[-0.19918, ...])
+	         where timestamps are in microseconds since epoch (see deserialize_utcmicros) and
+	         neg_logs are -log(price), the Bellman-Ford edge weights of the quotes
+	"""
+	mv = memoryview(b)  # slicing the view below is zero-copy, unlike slicing bytes
+	num_quotes = len(mv) // _QUOTE.size
+	if num_quotes == 0:
+		return Quotes([], [], [], [])
+
+	# One pass over the whole message, then regroup the fields into columns.
+	currencies, prices, timestamps = zip(*_QUOTE.iter_unpack(mv[:num_quotes * _QUOTE.size]))
+	crosses = _crosses
+	log = math.log
+	return Quotes(
+		[crosses.get(c) or _new_cross(c) for c in currencies],
+		list(prices),
+		[int.from_bytes(t, 'big') for t in timestamps],
+		[-log(p) for p in prices],
+	)
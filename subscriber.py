@@ -1,77 +1,154 @@
-import math
+import heapq
+import logging
 import time
-from datetime import datetime, timedelta, timezone
+from array import array
 import socket
 import threading
 import fxp_bytes_subscriber
-from bellman_ford import BellmanFord
+from fxp_bytes_subscriber import MICROS_PER_SECOND
+from bellmanford import BellmanFord
+from bf_numba import NUMBA_AVAILABLE, bf_csr
 
 MAX_BUFFER_SIZE = 1024
+LISTENER_PORT = 42555
 QUOTE_EXPIRATION_TIME = 0.1
 SUBSCRIPTION_EXPIRATION_TIME = 10 * 60
 QUOTE_STALE_TIMEOUT = 1.5 
+BELLMAN_FORD_TOLERANCE = 1e-12
 ARBITRAGE_START_AMOUNT = 100
+LOG_LEVEL = logging.DEBUG # logging.INFO mutes the per-quote QUOTE lines.
+
+logger = logging.getLogger(__name__)
+# Log level for each category passed to Subscriber.log.
+_CATEGORY_LEVEL = {
+    "QUOTE": logging.DEBUG,
+    "CLEANUP": logging.INFO,
+    "SYSTEM": logging.INFO,
+    "SUBSCRIBE": logging.INFO,
+    "ARBITRAGE": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+}
+
+
+class _LineFormatter(logging.Formatter):
+    """Formats each line of a multi-line message (a datagram's QUOTE lines, a traceback) as a log line of its own."""
+
+    def format(self, record):
+        if not hasattr(record, "category"): # Records that did not come through Subscriber.log.
+            record.category = record.levelname
+        lines = record.getMessage().split("\n")
+        if len(lines) == 1:
+            return super().format(record)
+        line_record = logging.makeLogRecord(record.__dict__)
+        formatted_lines = []
+        for line in lines:
+            line_record.msg, line_record.args = line, None
+            formatted_lines.append(super().format(line_record))
+        return "\n".join(formatted_lines)
 
 
 class Subscriber(object):
     def __init__(self, forex_provider_address):
         """Initializes the subscriber with connection addresses and data structures."""
-        self.listener_address = (socket.gethostbyname(socket.gethostname()), 42555)
+        self.listener_address = ('0.0.0.0', LISTENER_PORT) # Listen on all interfaces; no DNS lookup needed.
+        self._advertised_address = None # Address sent in SUBSCRIBE messages, resolved once by subscribe.
         self.forex_provider_address = forex_provider_address
-        self.rate_graph = {} # Stores currency pairs and their negative log rates for Bellman-Ford.
-        self.quote_timestamps = {} # Stores timestamps for quotes to check for staleness.
-
-    def add_to_graph(self, currencies, quote_data):
-        """Updates the rate_graph with a new quote and its reciprocal, using negative log rates."""
-        # The edges are the negative log of the current exchange rate.
-        forward_rate_neg_log = -1 * math.log(quote_data["price"])
-        quote_timestamp = quote_data["timestamp"]
+        self._bellman_ford = BellmanFord() # Owns the rate_graph edges; solves them directly when Numba is missing.
+        self.rate_graph = self._bellman_ford.edges # Stores currency pairs and their negative log rates for Bellman-Ford.
+        self.quote_timestamps = {} # Stores timestamps (microseconds since epoch) per market, keyed by its sorted currency pair.
+        self._expiry_heap = [] # (timestamp, market) per stored quote, oldest first, for cleanup_graph.
+        self.rate_prices = {} # Stores the exchange rate of each edge, so trades need not undo the log.
+        self._node_id = {} # Maps each currency to its vertex id in the CSR graph.
+        self._id_node = [] # Maps each CSR vertex id back to its currency.
+        self._csr_graph = None # (vertex_starts, edge_targets, edge_weights) built from rate_graph.
+        self._graph_dirty = False # Set whenever rate_graph changes, so negative cycles must be checked again.
+        self._edge_lowered = False # Set when an edge is added or lowered since the last find_arbitrage; only that can close a new cycle.
+        self._last_negative_edge = None # Result of the last Bellman-Ford run, reused while the graph is unchanged.
+
+    def add_vertex(self, currency):
+        """Assigns the next CSR vertex id to a currency seen for the first time."""
+        if currency not in self._node_id:
+            self._node_id[currency] = len(self._id_node)
+            self._id_node.append(currency)
+
+    def rebuild_csr_graph(self):
+        """Rebuilds the CSR arrays for Bellman-Ford from rate_graph, with edges grouped by source vertex id."""
+        vertex_starts = array('i', [0])
+        edge_targets = array('i')
+        edge_weights = array('d')
+        for source_curr in self._id_node:
+            for target_curr, weight in self.rate_graph.get(source_curr, {}).items():
+                edge_targets.append(self._node_id[target_curr])
+                edge_weights.append(weight)
+            vertex_starts.append(len(edge_targets))
+        self._csr_graph = (vertex_starts, edge_targets, edge_weights)
+
+    def add_to_graph(self, currencies, price, quote_timestamp, forward_rate_neg_log):
+        """
+        Updates the rate_graph with a new quote and its reciprocal, using negative log rates.
+        The quote's timestamp is only stored once both edges are in place.
+
+        >>> s = Subscriber(('localhost', 50403))
+        >>> s.add_to_graph(('USD', 'USD'), 1.0, 1, 0.0)
+        Traceback (most recent call last):
+        ...
+        ValueError: USD -> USD: 0.0
+        >>> s.quote_timestamps, s._expiry_heap
+        ({}, [])
+        """
+        # The edges are the negative log of the current exchange rate, computed while unmarshaling.
         
         base_currency = currencies[0]
         quote_currency = currencies[1]
-        
-        # This adds the base_currency -> quote_currency edge.
-        if base_currency not in self.rate_graph:
-            self.rate_graph[base_currency] = {}
-        self.rate_graph[base_currency][quote_currency] = forward_rate_neg_log
-        self.quote_timestamps[(base_currency, quote_currency)] = quote_timestamp
-
-        # An edge for the reciprocal rate (quote_currency -> base_currency) must also be added.
-        reciprocal_rate_neg_log = -1 * forward_rate_neg_log
-        if quote_currency not in self.rate_graph:
-            self.rate_graph[quote_currency] = {}
-        self.rate_graph[quote_currency][base_currency] = reciprocal_rate_neg_log
-        self.quote_timestamps[(quote_currency, base_currency)] = quote_timestamp
+
+        # An unchanged price leaves the graph (and the last Bellman-Ford result) as it is.
+        current_rate_neg_log = self.rate_graph.get(base_currency, {}).get(quote_currency)
+        if current_rate_neg_log is None or abs(current_rate_neg_log - forward_rate_neg_log) > BELLMAN_FORD_TOLERANCE:
+            # This adds the base_currency -> quote_currency edge.
+            self._bellman_ford.add_edge(base_currency, quote_currency, forward_rate_neg_log)
+            self.rate_prices[(base_currency, quote_currency)] = price
+
+            # An edge for the reciprocal rate (quote_currency -> base_currency) must also be added.
+            reciprocal_rate_neg_log = -1 * forward_rate_neg_log
+            self._bellman_ford.add_edge(quote_currency, base_currency, reciprocal_rate_neg_log)
+            self.rate_prices[(quote_currency, base_currency)] = 1.0 / price
+
+            self.add_vertex(base_currency)
+            self.add_vertex(quote_currency)
+            self._graph_dirty = True
+
+            # A changed price lowers one of the two directions; a new quote lowers both from infinity.
+            self._edge_lowered = True
+
+        # The quote stays in force either way, even if its price has not changed. Both edges share one
+        # timestamp, stored once under the market's sorted currency pair.
+        market = (base_currency, quote_currency) if base_currency < quote_currency else (quote_currency, base_currency)
+        self.quote_timestamps[market] = quote_timestamp
+        heapq.heappush(self._expiry_heap, (quote_timestamp, market))
 
     def cleanup_graph(self):
         """Removes stale quotes (edges) from the rate_graph that have exceeded the QUOTE_STALE_TIMEOUT."""
         # A published quote is assumed to remain in force for QUOTE_STALE_TIMEOUT.
-        stale_cutoff_time = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=QUOTE_STALE_TIMEOUT)
-
-        # This collects edges to delete.
-        edges_to_delete = [
-            (source_curr, target_curr) for (source_curr, target_curr), timestamp in self.quote_timestamps.items()
-            if timestamp <= stale_cutoff_time
-        ]
-
-        for (source_curr, target_curr) in edges_to_delete:
-            # Check for the forward rate.
-            if source_curr in self.rate_graph and target_curr in self.rate_graph[source_curr]:
-                del self.rate_graph[source_curr][target_curr]
-                self.log("CLEANUP", f"Removing stale quote for {source_curr, target_curr}")
-            
-            # The reciprocal edge is automatically removed here since both (u, v) and (v, u) are checked and deleted if found in timestamps.
-            if target_curr in self.rate_graph and source_curr in self.rate_graph[target_curr]:
-                del self.rate_graph[target_curr][source_curr]
+        stale_cutoff_time = int(time.time() * MICROS_PER_SECOND) - int(QUOTE_STALE_TIMEOUT * MICROS_PER_SECOND)
 
-            # Both timestamp entries must be removed.
-            if (source_curr, target_curr) in self.quote_timestamps:
-                del self.quote_timestamps[(source_curr, target_curr)]
-            
-            # The reciprocal timestamp key might be (v, u).
-            if (target_curr, source_curr) in self.quote_timestamps:
-                del self.quote_timestamps[(target_curr, source_curr)]
+        # Only the expired head of the heap is visited rather than every stored quote.
+        expiry_heap = self._expiry_heap
+        while expiry_heap and expiry_heap[0][0] <= stale_cutoff_time:
+            timestamp, market = heapq.heappop(expiry_heap)
+            # Skip entries superseded by a newer quote for the same market.
+            if self.quote_timestamps.get(market) != timestamp:
+                continue
+            del self.quote_timestamps[market]
 
+            # Both edges of the market go at once.
+            source_curr, target_curr = market
+            self._bellman_ford.remove_edge(source_curr, target_curr)
+            self._bellman_ford.remove_edge(target_curr, source_curr)
+            self.rate_prices.pop((source_curr, target_curr), None)
+            self.rate_prices.pop((target_curr, source_curr), None)
+            self._graph_dirty = True
+            self.log("CLEANUP", f"Removing stale quote for {source_curr, target_curr}")
 
     def print_arbitrage(self, predecessor_map, cycle_start_currency, initial_trade_amount=ARBITRAGE_START_AMOUNT):
         """
@@ -85,122 +162,191 @@ class Subscriber(object):
             self.log("WARNING", f"Cannot reconstruct path starting from {cycle_start_currency}")
             return
         
-        # Iterate through predecessor_map from the end to the beginning to reconstruct the cycle path.
-        cycle_steps = [cycle_start_currency]
-        current_step = predecessor_map[cycle_start_currency]
-        
-        visited_nodes = set()
-        # Loop until the cycle closes.
-        while current_step is not None and current_step not in visited_nodes:
-            cycle_steps.append(current_step)
-            visited_nodes.add(current_step)
-            current_step = predecessor_map.get(current_step, None)
-            # This stops the loop if we looped back to the origin.
-            if current_step == cycle_start_currency:
-                cycle_steps.append(current_step)
-                break
-
-        cycle_steps.reverse()
-        
-        # Ensure a valid cycle of at least two steps (e.g., A -> B -> A).
-        if len(cycle_steps) < 2 or cycle_steps[0] != cycle_steps[-1]:
+        # Follow predecessors forward from the start until a currency repeats; the path from the first
+        # visit of that currency onwards is the cycle (listed in predecessor order).
+        first_visit = {}
+        path = []
+        current_step = cycle_start_currency
+        while current_step is not None and current_step not in first_visit:
+            first_visit[current_step] = len(path)
+            path.append(current_step)
+            current_step = predecessor_map.get(current_step)
+
+        if current_step is None:
             return
+        cycle_steps = path[first_visit[current_step]:]
+        cycle_steps.append(current_step)
 
         # Log the beginning of the arbitrage sequence.
         self.log("ARBITRAGE", "Cycle found.")
         
         # Log the starting amount.
-        self.log("ARBITRAGE", f"Start with {cycle_start_currency} {initial_trade_amount}")
+        self.log("ARBITRAGE", f"Start with {current_step} {initial_trade_amount}")
         
         current_amount = initial_trade_amount
-        previous_currency = cycle_start_currency
-        
-        # Iterate up to the second to last step since the last step connects back to the start.
-        for i in range(1, len(cycle_steps)):
-            next_currency = cycle_steps[i]
-            # Handle the final step connecting back to the start.
-            if i == len(cycle_steps) - 1:
-                next_currency = cycle_steps[0] 
-
-            # Convert the negative log back into the exchange rate (price) and update the value.
+
+        # Trades run against the predecessor order, so walk the cycle from its end back to its beginning.
+        for i in range(len(cycle_steps) - 1, 0, -1):
+            previous_currency = cycle_steps[i]
+            next_currency = cycle_steps[i - 1]
+
+            # Look up the exchange rate (price) of this edge and update the value.
             if previous_currency not in self.rate_graph or next_currency not in self.rate_graph[previous_currency]:
                 self.log("WARNING", f"Edge {previous_currency}->{next_currency} missing during print_arbitrage.")
                 return 
 
-            exchange_rate = math.exp(-1 * self.rate_graph[previous_currency][next_currency])
+            exchange_rate = self.rate_prices[(previous_currency, next_currency)]
             current_amount *= exchange_rate
             
             self.log("ARBITRAGE", f"Exchange {previous_currency} for {next_currency} at {exchange_rate} --> {next_currency} {current_amount}")
-            previous_currency = next_currency
+
+    def may_have_negative_cycle(self):
+        """
+        Decides whether the changes since the last find_arbitrage may have left a negative cycle in rate_graph.
+        Without a cycle before, raising or removing edges cannot create one; only an added or lowered
+        edge can, and then the full search has to run.
+
+        >>> import math
+        >>> s = Subscriber(('localhost', 50403))
+        >>> now = int(time.time() * MICROS_PER_SECOND)
+        >>> s.add_to_graph(('GBP', 'USD'), 1.25, now, -math.log(1.25))
+        >>> s.add_to_graph(('EUR', 'USD'), 1.10, 1, -math.log(1.10))  # long stale
+        >>> s.may_have_negative_cycle()  # new edges
+        True
+        >>> s.find_arbitrage()  # no cycle
+        >>> s.cleanup_graph()  # removes EUR/USD
+        >>> s.may_have_negative_cycle()
+        False
+        >>> s.add_to_graph(('GBP', 'USD'), 1.26, now, -math.log(1.26))
+        >>> s.may_have_negative_cycle()  # USD -> GBP got cheaper
+        True
+        """
+        return self._edge_lowered or self._last_negative_edge is not None
+
+    def find_arbitrage(self):
+        """
+        Runs Bellman-Ford over the whole rate_graph and reports the arbitrage opportunity it finds, if any.
+        The compiled CSR solver is used when Numba is installed; in plain Python the dict-based solver is faster.
+        """
+        # Start node is arbitrary since we only care about cycles.
+        start_currency = 'USD' if 'USD' in self._node_id else self._id_node[0]
+        if NUMBA_AVAILABLE:
+            self.rebuild_csr_graph()
+            vertex_starts, edge_targets, edge_weights = self._csr_graph
+            _, predecessor_ids, negative_u, negative_v = bf_csr(
+                vertex_starts, edge_targets, edge_weights, self._node_id[start_currency], BELLMAN_FORD_TOLERANCE)
+
+            # Map vertex ids back to currencies for cycle reconstruction.
+            id_node = self._id_node
+            predecessors = {
+                id_node[v]: (id_node[u] if u >= 0 else None) for v, u in enumerate(predecessor_ids)
+            }
+            negative_edge = None
+            if negative_u >= 0:
+                negative_edge = (id_node[negative_u], id_node[negative_v])
+        else:
+            _, predecessors, negative_edge = self._bellman_ford.shortest_paths(start_currency, BELLMAN_FORD_TOLERANCE)
+        self._last_negative_edge = negative_edge
+        self._edge_lowered = False
+
+        # A negative_edge indicates a negative cycle (arbitrage).
+        if negative_edge is not None:
+
+            # Patch the predecessor dictionary to start cycle reconstruction.
+            u_node, v_node = negative_edge
+            if predecessors.get(v_node) is None:
+                predecessors[v_node] = u_node
+
+            # Start reconstruction at the node where the negative edge was found.
+            cycle_detection_node = negative_edge[0]
+
+            # Walk back |V| times to ensure the start node is inside the cycle.
+            num_nodes = len(self.rate_graph)
+            for _ in range(num_nodes):
+                cycle_detection_node = predecessors.get(cycle_detection_node, None)
+                if cycle_detection_node is None:
+                    break
+
+            # Report any arbitrage opportunities.
+            if cycle_detection_node is not None:
+                self.print_arbitrage(predecessors, cycle_detection_node)
+            else:
+                self.log("WARNING", "Could not reconstruct cycle (no valid predecessor chain)")
 
     def listen(self):
         """
         Binds the socket to listen for incoming forex quotes, processes them, and runs the Bellman-Ford algorithm
         to detect and report arbitrage opportunities.
         """
-        self.log("SYSTEM", f"Listening on {self.listener_address}")
         # Used to check for out-of-sequence quotes (latest quote timestamp seen across all markets).
-        last_processed_time = datetime.now() 
+        last_processed_time = int(time.time() * MICROS_PER_SECOND)
+        quote_expiration_micros = QUOTE_EXPIRATION_TIME * MICROS_PER_SECOND
 
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as listener_socket:
             listener_socket.bind(self.listener_address)
+            self.listener_address = listener_socket.getsockname()
+            self.log("SYSTEM", f"Listening on {self.listener_address}")
+            # Every datagram is received into this one buffer instead of a freshly allocated bytes object.
+            receive_buffer = bytearray(MAX_BUFFER_SIZE)
+            receive_view = memoryview(receive_buffer)
+
+            # Resolve the attributes used for every datagram and quote once, as locals.
+            receive_into = listener_socket.recvfrom_into
+            unmarshal_message = fxp_bytes_subscriber.unmarshal_message
+            split_cross = fxp_bytes_subscriber.split_cross
+            log = self.log
+            add_to_graph = self.add_to_graph
+            cleanup_graph = self.cleanup_graph
             while True:
                 try:
-                    byte_message, _ = listener_socket.recvfrom(MAX_BUFFER_SIZE)
-                    unmarshaled_quotes = fxp_bytes_subscriber.unmarshal_message(byte_message)
+                    num_bytes, _ = receive_into(receive_buffer, MAX_BUFFER_SIZE)
+                    unmarshaled_quotes = unmarshal_message(receive_view[:num_bytes])
+                    # The QUOTE lines of a datagram are only built when they would be shown, and then logged together.
+                    log_quotes = logger.isEnabledFor(logging.DEBUG)
+                    quote_lines = []
+                    ignored_quotes = []
 
-                    for quote_data in unmarshaled_quotes:
-                        quote_timestamp = quote_data["timestamp"]
-                        time_difference = (last_processed_time - quote_timestamp).total_seconds()
+                    for cross, price, quote_timestamp, neg_log in zip(*unmarshaled_quotes):
+                        time_difference = last_processed_time - quote_timestamp
                         
-                        currency_pair = quote_data["cross"].split("/")
-                        price_string = f"{currency_pair[0]} {currency_pair[1]} {quote_data['price']}"
+                        currency_pair = split_cross(cross)
+                        if log_quotes:
+                            quote_lines.append(f"{currency_pair[0]} {currency_pair[1]} {price}")
 
                         # Ignore any quotes with timestamps before the latest one seen for that market (within tolerance).
-                        if time_difference < QUOTE_EXPIRATION_TIME:
-                            self.log("QUOTE", f"{price_string}")
-                            self.add_to_graph(currency_pair, quote_data)
-                            last_processed_time = quote_data["timestamp"]
+                        if time_difference < quote_expiration_micros:
+                            add_to_graph(currency_pair, price, quote_timestamp, neg_log)
+                            last_processed_time = quote_timestamp
                         else:
-                            self.log("QUOTE", f"{price_string}")
-                            self.log("WARNING", "Ignoring out-of-sequence message")
+                            ignored_quotes.append((currency_pair, quote_timestamp))
 
-                    self.cleanup_graph()
+                    if quote_lines:
+                        log("QUOTE", "\n".join(quote_lines))
+                    for currency_pair, quote_timestamp in ignored_quotes:
+                        log("WARNING", f"Ignoring out-of-sequence message for {currency_pair[0]} {currency_pair[1]} "
+                                       f"at {quote_timestamp}")
+                    cleanup_graph()
 
-                    # Run Bellman-Ford to check for negative cycles.
-                    if self.rate_graph:
-                        bellman_ford = BellmanFord(self.rate_graph)
-                        # Start node is arbitrary since we only care about cycles.
-                        distances, predecessors, negative_edge = bellman_ford.shortest_paths('USD', 1e-12)
-                        
-                        # A negative_edge indicates a negative cycle (arbitrage).
-                        if negative_edge is not None:
-                            
-                            # Patch the predecessor dictionary to start cycle reconstruction.
-                            u_node, v_node = negative_edge
-                            if predecessors.get(v_node) is None:
-                                predecessors[v_node] = u_node
-                            
-                            # Start reconstruction at the node where the negative edge was found.
-                            cycle_detection_node = negative_edge[0]
-
-                            # Walk back |V| times to ensure the start node is inside the cycle.
-                            num_nodes = len(self.rate_graph)
-                            for _ in range(num_nodes):
-                                cycle_detection_node = predecessors.get(cycle_detection_node, None)
-                                if cycle_detection_node is None:
-                                    break
-
-                            # Report any arbitrage opportunities.
-                            if cycle_detection_node is not None:
-                                self.print_arbitrage(predecessors, cycle_detection_node)
-                            else:
-                                self.log("WARNING", "Could not reconstruct cycle (no valid predecessor chain)")
+                    # Run Bellman-Ford to check for negative cycles, unless no edge changed since the last check
+                    # or the changes cannot have created a cycle.
+                    if self._graph_dirty:
+                        self._graph_dirty = False
+                        if self.may_have_negative_cycle():
+                            self.find_arbitrage()
 
                 except Exception as e:
                     import traceback
-                    self.log("ERROR", f"Listener error: {e}")
-                    self.log("ERROR", traceback.format_exc())
+                    log("ERROR", f"Listener error: {e}")
+                    log("ERROR", traceback.format_exc())
+
+    def advertised_address(self):
+        """
+        Returns the address the forex provider should publish to: this host's IP and the listener's port.
+        The host name is only resolved the first time, since that lookup can block.
+        """
+        if self._advertised_address is None:
+            self._advertised_address = (socket.gethostbyname(socket.gethostname()), self.listener_address[1])
+        return self._advertised_address
 
     def subscribe(self):
         """
@@ -211,7 +357,7 @@ class Subscriber(object):
                 self.log("SUBSCRIBE", f"Sending SUBSCRIBE to {self.forex_provider_address}")
                 with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as subscriber_socket:
                     # fxp_bytes_subscriber.serialize_address returns the byte string of the address tuple
-                    serialized_listener_address = fxp_bytes_subscriber.serialize_address(self.listener_address)
+                    serialized_listener_address = fxp_bytes_subscriber.serialize_address(self.advertised_address())
                     subscriber_socket.sendto(serialized_listener_address, self.forex_provider_address)
                 
                 # Wait before renewing the subscription.
@@ -234,11 +380,14 @@ class Subscriber(object):
         subscribe_thread.join()
 
     def log(self, category, message):
-        """Prints a log message with a timestamp and category."""
-        print(f"[{datetime.now()}] [{category}]: {message}")
+        """Logs a message with its category; the timestamp and category are added by the logging handler."""
+        logger.log(_CATEGORY_LEVEL.get(category, logging.INFO), message, extra={"category": category})
 
 if __name__ == "__main__":
-    # Main execution block: defines the provider address and starts the Subscriber instance.
+    # Main execution block: configures logging, defines the provider address and starts the Subscriber instance.
+    handler = logging.StreamHandler()
+    handler.setFormatter(_LineFormatter("[%(asctime)s] [%(category)s]: %(message)s"))
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler])
     forex_provider_address = ("localhost", 50403)
     subscriber_instance = Subscriber(forex_provider_address)
     subscriber_instance.run()